@@ -1,6 +1,12 @@
+import asyncio
+import collections
+import contextlib
+import errno
+import inspect
 import logging
+import mimetypes
 import os
-import shlex
+import re
 import subprocess
 import tempfile
 import time
@@ -8,6 +14,7 @@ from pathlib import Path
 from typing import Optional
 
 from telegram import Update, Bot
+from telegram.constants import ChatAction
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
 
 import httpx
@@ -17,11 +24,24 @@ try:
 except Exception:
     HTTPXRequest = None
 
+# HTTPXRequest 的构造参数随 ptb 版本变化，导入时探测一次
+_HTTPX_REQUEST_PARAMS: set[str] = set(inspect.signature(HTTPXRequest).parameters) if HTTPXRequest else set()
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持（httpx[http2]）
+    _HAS_H2 = True
+except Exception:
+    _HAS_H2 = False
+
 # ============ Config ============
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 FFMPEG_BIN = os.getenv("FFMPEG_BIN", "ffmpeg")
 AUDIO_BITRATE = os.getenv("AUDIO_BITRATE", "192k")
 AUDIO_EXT = os.getenv("AUDIO_EXT", "mp3")
+# 码率控制：vbr（默认，有 VBR 参数的编码器使用 VBR）/ cbr（始终使用 AUDIO_BITRATE）
+AUDIO_RATE_MODE = os.getenv("AUDIO_RATE_MODE", "vbr").strip().lower()
+# mp3 VBR 质量（0 最好 ~ 9 最差）；留空时按 AUDIO_BITRATE 选择最接近的等级
+AUDIO_VBR_QUALITY = os.getenv("AUDIO_VBR_QUALITY", "").strip()
 
 # 自建 Bot API Server（例如 http://localhost:8081 或 http://tg-bot-api:8081）
 TG_BASE_URL = os.getenv("TG_BASE_URL", "").strip().rstrip("/")
@@ -47,15 +67,15 @@ def _env_bool(name: str, default: bool) -> bool:
         return default
     return str(v).strip().lower() in ("1", "true", "yes", "on")
 
+_ID_SEP = re.compile(r"[,\s]+")
+_ID_RE = re.compile(r"-?\d+")
+
 def _env_id_set(name: str) -> set[int]:
     raw = os.getenv(name, "")
-    ids: set[int] = set()
-    for part in raw.replace(",", " ").split():
-        try:
-            ids.add(int(part))
-        except Exception:
-            pass
-    return ids
+    return {int(p) for p in _ID_SEP.split(raw) if _ID_RE.fullmatch(p)}
+
+# 自建 Bot API 的 --local 模式：上传时只传文件路径（要求 bot-api 能以相同路径读到临时目录，见 TG_V2A_TMPDIR）
+TG_LOCAL_MODE = _env_bool("TG_LOCAL_MODE", False)
 
 # HTTP 超时/连接池（大文件友好）
 CONNECT_TIMEOUT = _env_float("TG_CONNECT_TIMEOUT", 30.0)
@@ -65,17 +85,57 @@ POOL_TIMEOUT = _env_float("TG_POOL_TIMEOUT", 60.0)
 MAX_CONNECTIONS = _env_int("TG_MAX_CONNECTIONS", 100)
 MAX_KEEPALIVE = _env_int("TG_MAX_KEEPALIVE", 20)
 
+# 已发送音频的 Telegram file_id 缓存（同一视频再次出现时直接转发，不再下载/转换/上传）
+AUDIO_CACHE_SIZE = _env_int("AUDIO_CACHE_SIZE", 256)
+AUDIO_CACHE_TTL = _env_float("AUDIO_CACHE_TTL", 3600.0)
+
+# ffmpeg 失败时记录的 stderr 末尾行数
+FFMPEG_STDERR_TAIL_LINES = 40
+
+# 多音轨视频中抽取第几条音频流（从 0 开始）
+AUDIO_STREAM_INDEX = max(0, _env_int("AUDIO_STREAM_INDEX", 0))
+
+# 小于该大小（字节）的视频下载到内存后直接经 stdin 交给 ffmpeg
+SMALL_VIDEO_BYTES = _env_int("SMALL_VIDEO_BYTES", 8 * 1024 * 1024)
+
+# 视频大小上限（字节），超出直接拒绝，不下载；0 表示不限制
+MAX_VIDEO_BYTES = max(0, _env_int("MAX_VIDEO_BYTES", 0))
+
+# 同时运行的 ffmpeg 进程上限（默认 CPU 核数的一半）
+MAX_CONCURRENT_FFMPEG = max(1, _env_int("MAX_CONCURRENT_FFMPEG", (os.cpu_count() or 2) // 2))
+
+# 转换进度消息的最小编辑间隔（秒）
+FFMPEG_PROGRESS_INTERVAL = 3.0
+
+# 直链下载的分块大小（大块减少每块的 Python 层开销与系统调用次数）
+DOWNLOAD_CHUNK_SIZE = max(64 * 1024, _env_int("TG_DOWNLOAD_CHUNK_SIZE", 1 << 20))
+
 # 清理策略
 CLEANUP_OUTPUT = _env_bool("CLEANUP_OUTPUT", True)
 CLEANUP_LOCAL_SOURCE = _env_bool("CLEANUP_LOCAL_SOURCE", True)
 
 # 鉴权白名单
-ALLOWED_USER_IDS: set[int] = _env_id_set("ALLOWED_USER_IDS")   # 用户白名单
-ALLOWED_CHAT_IDS: set[int] = _env_id_set("ALLOWED_CHAT_IDS")   # 聊天白名单（群/超群/频道）
+ALLOWED_USER_IDS: frozenset[int] = frozenset(_env_id_set("ALLOWED_USER_IDS"))   # 用户白名单
+ALLOWED_CHAT_IDS: frozenset[int] = frozenset(_env_id_set("ALLOWED_CHAT_IDS"))   # 聊天白名单（群/超群/频道）
 
 # 手动直链下载前缀（初始化于 _build_application）
 FILE_URL_PREFIX = ""  # http://host:port/file/bot<token>
 
+# (视频 file_unique_id, AUDIO_EXT, AUDIO_BITRATE) → (audio file_id, 过期时间)，LRU 顺序
+_AUDIO_CACHE: collections.OrderedDict[tuple, tuple[str, float]] = collections.OrderedDict()
+# 正在转换中的视频 → 结果 Future（audio file_id 或 None）
+_INFLIGHT: dict[tuple, asyncio.Future] = {}
+
+# 限制同时运行的 ffmpeg 数量，避免并发转码争抢 CPU/磁盘
+_FFMPEG_SEM = asyncio.Semaphore(MAX_CONCURRENT_FFMPEG)
+
+# 直链下载共用的 HTTP 客户端（初始化于 _build_application，post_shutdown 时关闭），复用 keep-alive 连接
+_HTTPX_CLIENT: Optional[httpx.AsyncClient] = None
+
+# 临时目录：TG_V2A_TMPDIR 显式指定时始终使用；否则空间足够时优先 /dev/shm（内存盘），再退回系统默认
+TMPDIR_OVERRIDE = os.getenv("TG_V2A_TMPDIR", "").strip() or None
+SHM_DIR = "/dev/shm"
+
 # Bot API 本地缓存目录（固定值；要求两容器路径一致）
 BOT_API_LOCAL_ROOT = "/var/lib/telegram-bot-api/"
 
@@ -95,6 +155,10 @@ def _has_ffmpeg() -> bool:
         return False
 
 
+# ffmpeg 可用性在进程生命周期内不变：于 _build_application 启动时探测一次
+_FFMPEG_OK = False
+
+
 def _suggest_filename(base: Optional[str], default_stem: str, ext: str) -> str:
     try:
         stem = Path(base).stem if base else default_stem
@@ -104,94 +168,318 @@ def _suggest_filename(base: Optional[str], default_stem: str, ext: str) -> str:
         return f"{default_stem}.{ext.lstrip('.')}"
 
 
+_SIZE_UNITS = ("B", "KB", "MB", "GB", "TB")
+
+
 def _human_size(n_bytes: int) -> str:
     if n_bytes is None:
         return "0 B"
-    units = ["B", "KB", "MB", "GB", "TB"]
-    size = float(n_bytes)
-    for u in units:
-        if size < 1024 or u == units[-1]:
-            if u in ("MB", "GB", "TB"):
-                return f"{size:.1f} {u}"
-            return f"{int(size)} {u}"
-        size /= 1024.0
-    return f"{size:.1f} TB"
+    n = int(n_bytes)
+    if n < 1024:
+        return f"{max(n, 0)} B"
+    # bit_length 直接得到数量级，无需逐级除 1024
+    exp = min((n.bit_length() - 1) // 10, len(_SIZE_UNITS) - 1)
+    if exp == 1:
+        return f"{n >> 10} KB"
+    return f"{n / (1 << (exp * 10)):.1f} {_SIZE_UNITS[exp]}"
 
 
 def _fmt_speed(bytes_per_sec: float) -> str:
     return f"{_human_size(bytes_per_sec)}/s"
 
 
-async def _download_with_progress(url: str, dest: Path, status_msg):
+class _VideoTooLarge(Exception):
+    """下载中发现视频超过 MAX_VIDEO_BYTES（重试无意义，需单独提示用户）。"""
+
+
+def _too_large_text() -> str:
+    return f"文件过大（上限 {_human_size(MAX_VIDEO_BYTES)}）。"
+
+
+async def _stream_with_progress(url: str, write_chunk, status_msg):
     """
+    流式下载 url，每个数据块交给 write_chunk（协程）处理；write_chunk 返回 False 时提前结束。
     仅发送与编辑一个消息：
     - 初始：下载中…
     - 过程中：下载中… 进度/大小/速度
     - 完成：编辑为“转换中…”
     """
-    timeout = httpx.Timeout(connect=CONNECT_TIMEOUT, read=READ_TIMEOUT, write=WRITE_TIMEOUT)
-    limits = httpx.Limits(max_keepalive_connections=MAX_KEEPALIVE, max_connections=MAX_CONNECTIONS)
+    start_ns = time.monotonic_ns()
+    next_edit_ns = start_ns + 1_000_000_000  # 初始提示之后 1 秒再开始更新进度
+
+    if _HTTPX_CLIENT is None:
+        raise RuntimeError("HTTP client not initialized")
+    async with _HTTPX_CLIENT.stream("GET", url) as resp:
+        resp.raise_for_status()
+        total = int(resp.headers.get("Content-Length") or 0)
+        if MAX_VIDEO_BYTES and total > MAX_VIDEO_BYTES:
+            raise _VideoTooLarge(f"Content-Length {total} exceeds MAX_VIDEO_BYTES {MAX_VIDEO_BYTES}")
+
+        # 初始提示
+        try:
+            if total > 0:
+                await status_msg.edit_text(f"下载中… 0% (0 / {_human_size(total)}) 0 B/s")
+            else:
+                await status_msg.edit_text("下载中… (大小未知)")
+        except Exception:
+            pass
 
-    last_edit = 0.0
-    last_bytes = 0
-    start = time.monotonic()
+        downloaded = 0
+        # 进度编辑放到后台任务，不阻塞读取；上一次编辑未完成时跳过本次更新（已发出的请求无法撤回，
+        # 取消重发只会增加 API 调用、触发 Telegram 限流）
+        pending_edit: Optional[asyncio.Task] = None
+        try:
+            async for chunk in resp.aiter_bytes(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if not chunk:
+                    continue
+                if not await write_chunk(chunk):
+                    break
+                downloaded += len(chunk)
+                if MAX_VIDEO_BYTES and downloaded > MAX_VIDEO_BYTES:
+                    raise _VideoTooLarge(f"Download exceeds MAX_VIDEO_BYTES {MAX_VIDEO_BYTES}")
+
+                now_ns = time.monotonic_ns()
+                # 节流：每秒最多编辑一次（整数比较，无浮点运算），且同一时间只有一个编辑在途
+                if now_ns < next_edit_ns or (pending_edit and not pending_edit.done()):
+                    continue
+
+                elapsed = max(now_ns - start_ns, 1) / 1e9
+                speed = (downloaded / elapsed)
+                if total > 0:
+                    pct = downloaded * 100 // total
+                    text = f"下载中… {pct}% ({_human_size(downloaded)} / {_human_size(total)}) {_fmt_speed(speed)}"
+                else:
+                    text = f"下载中… {_human_size(downloaded)} {_fmt_speed(speed)}"
+                pending_edit = asyncio.create_task(_edit_quietly(status_msg, text))
+                next_edit_ns = now_ns + 1_000_000_000
+        except BaseException:
+            if pending_edit and not pending_edit.done():
+                pending_edit.cancel()
+            raise
+
+    # 先等待仍在进行的进度编辑完成，避免其晚于“转换中…”到达而覆盖状态
+    if pending_edit and not pending_edit.done():
+        # asyncio.wait 不抛出子任务的异常，外层被取消时仍正常传播
+        await asyncio.wait((pending_edit,))
+
+    # 下载完成 → 转换中
+    await _edit_quietly(status_msg, "转换中…")
 
-    async with httpx.AsyncClient(timeout=timeout, limits=limits, follow_redirects=True) as client:
-        async with client.stream("GET", url) as resp:
-            resp.raise_for_status()
-            total = int(resp.headers.get("Content-Length") or 0)
 
-            # 初始提示
+async def _edit_quietly(status_msg, text: str):
+    try:
+        await status_msg.edit_text(text)
+    except Exception:
+        pass
+
+
+_WRITE_BATCH_BYTES = 4 << 20
+
+
+def _write_all(fd: int, data) -> None:
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+async def _download_with_progress(url: str, dest: Path, status_msg, expected_bytes: Optional[int] = None):
+    """
+    下载到本地文件（ffmpeg 无法从管道解复用时的回退路径）。
+    数据块攒到约 4 MB 后交给线程写盘，避免慢盘阻塞事件循环。
+    已知大小时预分配空间：尽早暴露空间不足，并让文件系统分配连续区段。
+    """
+    fd = os.open(str(dest), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+    try:
+        if expected_bytes and expected_bytes > 0 and hasattr(os, "posix_fallocate"):
             try:
-                if total > 0:
-                    await status_msg.edit_text(f"下载中… 0% (0 / {_human_size(total)}) 0 B/s")
-                else:
-                    await status_msg.edit_text("下载中… (大小未知)")
+                await asyncio.to_thread(os.posix_fallocate, fd, 0, expected_bytes)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    raise
+                # 文件系统不支持预分配时忽略
+        buf = bytearray()
+        written = 0
+
+        async def _write(chunk: bytes) -> bool:
+            nonlocal buf, written
+            buf += chunk
+            if len(buf) >= _WRITE_BATCH_BYTES:
+                data, buf = buf, bytearray()
+                await asyncio.to_thread(_write_all, fd, data)
+                written += len(data)
+            return True
+
+        await _stream_with_progress(url, _write, status_msg)
+        if buf:
+            await asyncio.to_thread(_write_all, fd, buf)
+            written += len(buf)
+        if expected_bytes and written != expected_bytes:
+            # 实际大小与预分配不符时截断，避免文件尾部残留预分配的空白
+            os.ftruncate(fd, written)
+    finally:
+        os.close(fd)
+
+
+async def _ffmpeg_from_stdin(cmd: list[str], feed) -> tuple[int, str]:
+    """
+    运行从 stdin 读取输入的 ffmpeg（cmd 需使用 -i pipe:0），返回 (退出码, stderr 末尾)。
+    feed(write_chunk) 负责写入数据；write_chunk 返回 False 表示 ffmpeg 已提前退出。
+    feed 抛出异常时终止 ffmpeg 并向上抛出。
+    """
+    logger.info("Running ffmpeg (stdin): %r", cmd)
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    # 必须并发读取 stderr，否则管道写满后 ffmpeg 会阻塞
+    stderr_tail: collections.deque[bytes] = collections.deque(maxlen=FFMPEG_STDERR_TAIL_LINES)
+    stderr_task = asyncio.create_task(_collect_stderr_tail(proc.stderr, stderr_tail))
+
+    async def _write(chunk: bytes) -> bool:
+        try:
+            proc.stdin.write(chunk)
+            await proc.stdin.drain()
+            return True
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg 已提前退出（通常是无法识别输入），停止写入
+            return False
+
+    try:
+        await feed(_write)
+    except BaseException:
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+        stderr_task.cancel()
+        raise
+
+    try:
+        proc.stdin.close()
+        await proc.stdin.wait_closed()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    returncode = await proc.wait()
+    await stderr_task
+    return returncode, b"".join(stderr_tail).decode("utf-8", "replace")
+
+
+async def _stream_to_ffmpeg(url: str, cmd: list[str], status_msg) -> tuple[int, str]:
+    """
+    边下载边转换：将响应体直接写入 ffmpeg 的 stdin，不落盘。下载异常时终止 ffmpeg 并向上抛出。
+    """
+    return await _ffmpeg_from_stdin(cmd, lambda write: _stream_with_progress(url, write, status_msg))
+
+
+async def _bytes_to_ffmpeg(data: bytearray, cmd: list[str]) -> tuple[int, str]:
+    """
+    将内存中的完整输入写入 ffmpeg 的 stdin（小文件路径）。
+    """
+    return await _ffmpeg_from_stdin(cmd, lambda write: write(data))
+
+
+async def _collect_stderr_tail(stream: asyncio.StreamReader, tail: collections.deque):
+    """
+    逐行读取 stderr，仅保留最后若干行（deque 自动丢弃旧行）。
+    """
+    while True:
+        try:
+            line = await stream.readline()
+        except ValueError:
+            # 单行超过 StreamReader 缓冲上限（如 \r 刷新的进度行），已被丢弃，继续读取
+            continue
+        if not line:
+            break
+        tail.append(line)
+
+
+async def _read_ffmpeg_progress(stream: asyncio.StreamReader, on_progress):
+    """
+    解析 -progress 输出（key=value 行，每块以 progress=... 结束），每块回调 on_progress(已转换秒数, 输出字节数)。
+    """
+    out_time_us = 0
+    total_size = 0
+    async for raw in stream:
+        key, _, value = raw.decode("utf-8", "replace").strip().partition("=")
+        if key == "out_time_ms" and value.isdigit():
+            out_time_us = int(value)  # 名为 ms，实为微秒（ffmpeg 历史命名）
+        elif key == "total_size" and value.isdigit():
+            total_size = int(value)
+        elif key == "progress":
+            try:
+                await on_progress(out_time_us / 1_000_000, total_size)
             except Exception:
                 pass
 
-            with open(dest, "wb") as f:
-                downloaded = 0
-                async for chunk in resp.aiter_bytes():
-                    if not chunk:
-                        continue
-                    f.write(chunk)
-                    downloaded += len(chunk)
-
-                    now = time.monotonic()
-                    # 节流：每秒最多编辑一次，且至少前进 1%
-                    need_update = False
-                    if now - last_edit >= 1.0:
-                        need_update = True
-                    elif total > 0:
-                        prev_pct = int((last_bytes / total) * 100)
-                        curr_pct = int((downloaded / total) * 100)
-                        if curr_pct > prev_pct:
-                            need_update = True
-
-                    if need_update:
-                        elapsed = max(now - start, 1e-6)
-                        speed = (downloaded / elapsed)
-                        try:
-                            if total > 0:
-                                pct = int(downloaded * 100 / total)
-                                await status_msg.edit_text(
-                                    f"下载中… {pct}% ({_human_size(downloaded)} / {_human_size(total)}) {_fmt_speed(speed)}"
-                                )
-                            else:
-                                await status_msg.edit_text(
-                                    f"下载中… {_human_size(downloaded)} {_fmt_speed(speed)}"
-                                )
-                        except Exception:
-                            pass
-                        last_edit = now
-                        last_bytes = downloaded
 
-    # 下载完成 → 转换中
+async def _run_ffmpeg(cmd: list[str], on_progress=None) -> tuple[int, str]:
+    """
+    异步运行 ffmpeg（不阻塞事件循环），返回 (退出码, stderr 末尾)。
+    cmd 含 -progress pipe:1 时传入 on_progress 以接收进度。
+    """
+    logger.info("Running ffmpeg: %r", cmd)
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE if on_progress else asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stderr_tail: collections.deque[bytes] = collections.deque(maxlen=FFMPEG_STDERR_TAIL_LINES)
+    readers = [_collect_stderr_tail(proc.stderr, stderr_tail)]
+    if on_progress:
+        readers.append(_read_ffmpeg_progress(proc.stdout, on_progress))
+    await asyncio.gather(*readers)
+    returncode = await proc.wait()
+    return returncode, b"".join(stderr_tail).decode("utf-8", "replace")
+
+
+async def _chat_action_heartbeat(bot, chat_id: int, action: str, interval: float = 4.0):
+    """
+    周期性发送 chat action（Telegram 约 5 秒后自动消失），直到被取消。
+    """
+    while True:
+        try:
+            await bot.send_chat_action(chat_id=chat_id, action=action)
+        except Exception:
+            pass
+        await asyncio.sleep(interval)
+
+
+@contextlib.asynccontextmanager
+async def _ffmpeg_slot(status_msg, resume_text: str):
+    """
+    占用一个 ffmpeg 并发名额（_FFMPEG_SEM）。需要排队时将状态改为“排队中…”并保持 chat action，
+    获得名额后恢复为 resume_text。
+    """
+    if _FFMPEG_SEM.locked() and status_msg:
+        try:
+            await status_msg.edit_text("排队中…")
+        except Exception:
+            pass
+        heartbeat = asyncio.create_task(
+            _chat_action_heartbeat(status_msg.get_bot(), status_msg.chat_id, ChatAction.RECORD_VOICE)
+        )
+        try:
+            await _FFMPEG_SEM.acquire()
+        finally:
+            heartbeat.cancel()
+        try:
+            await status_msg.edit_text(resume_text)
+        except Exception:
+            pass
+    else:
+        await _FFMPEG_SEM.acquire()
     try:
-        await status_msg.edit_text("转换中…")
-    except Exception:
-        pass
+        yield
+    finally:
+        _FFMPEG_SEM.release()
 
 
 def _build_direct_file_url(file_path: str) -> Optional[str]:
@@ -226,6 +514,27 @@ def _pick_local_source(file_path: str) -> Optional[str]:
     return None
 
 
+def _pick_tmp_root(expected_bytes: Optional[int]) -> Optional[str]:
+    """
+    选择临时目录的父目录（None 表示系统默认 TMPDIR）。
+    /dev/shm 容量通常有限（Docker 默认 64MB），仅在已知大小且剩余空间足够（输入 + 输出余量）时使用。
+    """
+    if TMPDIR_OVERRIDE:
+        return TMPDIR_OVERRIDE
+    # 本地模式下 bot-api 需按路径读取输出文件，不使用只有本容器可见的内存盘
+    if TG_LOCAL_MODE:
+        return None
+    if not expected_bytes or not os.path.isdir(SHM_DIR) or not os.access(SHM_DIR, os.W_OK):
+        return None
+    try:
+        st = os.statvfs(SHM_DIR)
+    except OSError:
+        return None
+    if st.f_bavail * st.f_frsize < expected_bytes * 2:
+        return None
+    return SHM_DIR
+
+
 def _safe_unlink(path: Path):
     try:
         if path.exists():
@@ -235,22 +544,51 @@ def _safe_unlink(path: Path):
         logger.warning("Failed to delete file %s: %s", path, e)
 
 
-def _safe_remove_local_source(local_src: Optional[str]):
+def _drop_page_cache(path: Path):
+    """
+    提示内核丢弃该文件的页缓存（ffmpeg 已读完，避免大视频挤掉其他有用的缓存）。
+    平台不支持 posix_fadvise 时忽略。
     """
-    安全删除 bot-api 缓存中的源视频：
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _is_removable_local_source(local_src: Optional[str]) -> bool:
+    """
+    是否允许删除 bot-api 缓存中的源视频：
     - 仅在 CLEANUP_LOCAL_SOURCE 开启时
     - 仅删除位于 /var/lib/telegram-bot-api/<token>/... 下的文件
     """
     if not local_src or not CLEANUP_LOCAL_SOURCE:
-        return
+        return False
 
     if not local_src.startswith(BOT_API_LOCAL_ROOT):
         logger.warning("Skip deleting local source outside BOT_API_LOCAL_ROOT: %s", local_src)
-        return
+        return False
 
     token_prefix = os.path.join(BOT_API_LOCAL_ROOT, BOT_TOKEN)
     if not local_src.startswith(token_prefix):
         logger.warning("Skip deleting local source not under this bot token dir: %s", local_src)
+        return False
+
+    return True
+
+
+def _safe_remove_local_source(local_src: Optional[str]):
+    """
+    安全删除 bot-api 缓存中的源视频（校验见 _is_removable_local_source）。
+    """
+    if not _is_removable_local_source(local_src):
         return
 
     try:
@@ -261,94 +599,349 @@ def _safe_remove_local_source(local_src: Optional[str]):
         logger.warning("Failed to delete local source %s: %s", local_src, e)
 
 
-def _probe_duration_seconds(path: Path) -> Optional[int]:
+def _adopt_local_source(local_src: str, dest: Path) -> Optional[Path]:
+    """
+    将 bot-api 缓存中的源视频移动（rename，同文件系统 O(1)）到临时目录，之后随临时目录一并清理，
+    即使转换中途失败也不会残留缓存。
+    不允许删除源视频或无法移动（如跨设备 EXDEV）时返回 None，沿用原路径直读（零复制），转换后再删除。
+    """
+    if not _is_removable_local_source(local_src):
+        return None
+    try:
+        os.rename(local_src, dest)
+    except OSError as e:
+        logger.info("Move of local source failed, reading in place: %s (%s)", local_src, e)
+        return None
+    logger.info("Moved local source into temp dir: %s", local_src)
+    return dest
+
+
+async def _probe_duration_seconds(path: Path) -> Optional[int]:
     """
     使用 ffprobe 读取音频时长（秒，四舍五入）。若失败返回 None。
     """
     try:
-        # 优先读音频流时长，其次读容器时长
-        cmd = ["ffprobe", "-v", "error", "-select_streams", "a:0", "-show_entries", "stream=duration",
-               "-of", "default=nw=1:nk=1", str(path)]
-        r = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        out = (r.stdout or "").strip()
-        if not out or out == "N/A":
-            cmd2 = ["ffprobe", "-v", "error", "-show_entries", "format=duration",
-                    "-of", "default=nw=1:nk=1", str(path)]
-            r2 = subprocess.run(cmd2, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            out = (r2.stdout or "").strip()
-        if out and out != "N/A":
-            seconds = float(out)
-            if seconds > 0:
-                return int(round(seconds))
+        # 一次调用同时读取音频流与容器时长：ffprobe 先输出流、后输出容器，优先取音频流时长
+        proc = await asyncio.create_subprocess_exec(
+            "ffprobe", "-v", "error", "-select_streams", "a:0",
+            "-show_entries", "stream=duration:format=duration",
+            "-of", "default=nw=1:nk=1", str(path),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        out, _ = await proc.communicate()
+        for value in out.decode("utf-8", "replace").split():
+            if value != "N/A":
+                seconds = float(value)
+                if seconds > 0:
+                    return int(round(seconds))
     except Exception as e:
         logger.debug("ffprobe duration failed: %s", e)
     return None
 
 
-async def handle_video_like(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # 只维护一个“进度/状态”消息：下载中…（带进度/速度）→ 转换中… → 成功后删除；失败则将其改为错误信息
-    if not _has_ffmpeg():
-        try:
-            await update.effective_message.reply_text("转换失败：服务器未安装 ffmpeg。")
-        except Exception:
-            pass
-        return
+# LAME VBR 等级 V0 ~ V9 的平均码率（kbps）
+_LAME_VBR_KBPS = (245, 225, 190, 175, 165, 130, 115, 100, 85, 65)
 
-    msg = update.effective_message
-    video = None
-    filename = None
 
-    if msg.video:
-        video = msg.video
-        filename = getattr(video, "file_name", None)
-    elif msg.video_note:
-        video = msg.video_note
-        filename = None
-    elif msg.document and msg.document.mime_type and msg.document.mime_type.startswith("video/"):
-        video = msg.document
-        filename = msg.document.file_name
+def _lame_vbr_quality(bitrate: str) -> Optional[str]:
+    """
+    按 AUDIO_BITRATE 选择平均码率最接近的 LAME VBR 等级（-q:a），使 VBR 不偏离用户设置的码率；
+    码率高于 V0 的平均值（如 320k）时 VBR 无法达到，返回 None 改用 CBR。无法解析时取 2（约 190kbps）。
+    """
+    m = re.fullmatch(r"(\d+)(k?)", (bitrate or "").strip().lower())
+    if not m:
+        return "2"
+    kbps = int(m.group(1)) if m.group(2) else int(m.group(1)) // 1000
+    if kbps > _LAME_VBR_KBPS[0]:
+        return None
+    return str(min(range(len(_LAME_VBR_KBPS)), key=lambda q: abs(_LAME_VBR_KBPS[q] - kbps)))
 
-    if not video:
-        return  # 不多发消息
 
+# 编码器 → VBR 码率控制参数（AUDIO_RATE_MODE=vbr 时替代 -b:a 的 CBR，编码更快）
+_MP3_VBR_QUALITY = AUDIO_VBR_QUALITY or _lame_vbr_quality(AUDIO_BITRATE)
+_VBR_ARGS = {"libmp3lame": ["-q:a", _MP3_VBR_QUALITY]} if _MP3_VBR_QUALITY else {}
+
+# 编码器专属调优：aac 使用快速编码器搜索；libopus 使用较长帧、较低复杂度（默认 10 最慢）
+_ENCODER_TUNING = {
+    "aac": ["-aac_coder", "fast"],
+    "libopus": ["-application", "audio", "-frame_duration", "60", "-compression_level", "6"],
+}
+
+# 源音频编码 → 可直接 stream copy（不解码/编码）的输出格式
+_COPY_COMPATIBLE_EXTS = {
+    "aac": {"m4a", "aac"},
+    "mp3": {"mp3"},
+    "opus": {"opus", "ogg", "oga"},
+    "flac": {"flac"},
+    "pcm_s16le": {"wav"},
+}
+
+
+async def _probe_input(path: Path) -> tuple[Optional[str], Optional[float]]:
+    """
+    使用 ffprobe 读取所选音频流（AUDIO_STREAM_INDEX）的编码名（如 aac/mp3/opus）与容器时长（秒）。失败的项为 None。
+    """
+    codec, duration = None, None
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "ffprobe", "-v", "error", "-select_streams", f"a:{AUDIO_STREAM_INDEX}",
+            "-show_entries", "stream=codec_name:format=duration",
+            "-of", "default=nw=1", str(path),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        out, _ = await proc.communicate()
+        for line in out.decode("utf-8", "replace").splitlines():
+            key, _, value = line.strip().partition("=")
+            if key == "codec_name" and value:
+                codec = value.lower()
+            elif key == "duration" and value and value != "N/A":
+                duration = float(value)
+    except Exception as e:
+        logger.debug("ffprobe input failed: %s", e)
+    return codec, duration
+
+
+def _can_copy_audio(src_codec: Optional[str]) -> bool:
+    return bool(src_codec) and _OUT_EXT in _COPY_COMPATIBLE_EXTS.get(src_codec, ())
+
+
+# 文件扩展名 → ffmpeg 解复用器，用于管道输入（无法 seek 探测）时显式指定 -f
+# 提示错误时解复用失败，由 _is_pipe_demux_failure 从 stderr 识别后回退为按文件（正常探测）转换
+_PIPE_DEMUXERS = {
+    ".mp4": "mov",
+    ".m4v": "mov",
+    ".mov": "mov",
+    ".3gp": "mov",
+    ".mkv": "matroska",
+    ".webm": "matroska",
+    ".avi": "avi",
+    ".ts": "mpegts",
+    ".flv": "flv",
+}
+
+
+def _pipe_demuxer_for(file_path: str) -> Optional[str]:
+    return _PIPE_DEMUXERS.get(Path(file_path or "").suffix.lower())
+
+
+# 输出格式 → 编码器
+_CODEC_MAP = {
+    "mp3": "libmp3lame",
+    "m4a": "aac",
+    "aac": "aac",
+    "opus": "libopus",
+    "ogg": "libopus",
+    "oga": "libopus",
+    "flac": "flac",
+    "wav": "pcm_s16le",
+}
+
+
+def _encode_args(ext: str, acodec: str) -> tuple[str, ...]:
+    args = ["-acodec", acodec, "-threads", "0"]  # 编码侧同样自动线程（多线程编码器可用）
+    if AUDIO_RATE_MODE == "vbr" and acodec in _VBR_ARGS:
+        args += _VBR_ARGS[acodec]
+    elif ext in {"mp3", "m4a", "aac", "opus", "ogg"} and AUDIO_BITRATE:
+        args += ["-b:a", AUDIO_BITRATE]
+    if ext in {"opus", "ogg"}:
+        args += ["-vbr", "on"]
+    args += _ENCODER_TUNING.get(acodec, [])
+    return tuple(args)
+
+
+def _muxer_args(ext: str) -> tuple[str, ...]:
+    # 关键：为不同封装补上便于 Telegram 识别时长的元数据/封装选项
+    if ext == "mp3":
+        # 写入 Xing/LAME 头以携带精确时长（尤其是 VBR）
+        return ("-write_xing", "1", "-id3v2_version", "3")
+    if ext == "m4a":
+        # 将 moov 元数据前移，部分客户端依赖此以正确读取
+        return ("-movflags", "+faststart")
+    # aac：ADTS 裸流本身对部分客户端不友好，时长可能不稳定
+    # 建议使用 m4a；这里保留 aac 以兼容你的选择
+    return ()
+
+
+# 输出格式/编码参数在进程内固定：导入时算好，每次转换只拼接
+_OUT_EXT = AUDIO_EXT.lower()
+_ACODEC = _CODEC_MAP.get(_OUT_EXT, "libmp3lame")
+_ENCODE_ARGS = _encode_args(_OUT_EXT, _ACODEC)
+_COPY_ARGS = ("-c:a", "copy")
+_MUXER_ARGS = _muxer_args(_OUT_EXT)
+_STREAM_ARGS = (
+    # 只选取一条音频流；其余视频/数据/字幕流在解复用层即被丢弃
+    "-map", f"0:a:{AUDIO_STREAM_INDEX}",
+    "-vn", "-dn", "-sn",
+)
+
+
+def _build_ffmpeg_cmd(
+    input_arg: str,
+    out_path: Path,
+    copy_audio: bool = False,
+    progress: bool = False,
+    input_format: Optional[str] = None,
+) -> list[str]:
+    """
+    构造 ffmpeg 抽取音频命令；input_arg 为本地路径或 "pipe:0"。
+    copy_audio=True 时直接复制音频流（源编码已与目标格式一致），跳过重新编码。
+    progress=True 时将机器可读的进度写到 stdout（-progress pipe:1）。
+    input_format 为输入解复用器提示（-f），管道输入时省去格式探测。
+    """
+    cmd = [FFMPEG_BIN, "-y", "-hide_banner", "-loglevel", "error"]
+    if input_arg != "pipe:0":
+        cmd.append("-nostdin")  # 文件输入时不监听 stdin 交互
+    if progress:
+        cmd += ["-progress", "pipe:1"]
+    cmd += [
+        "-filter_threads", "0",  # 滤镜（重采样等）线程数自动
+        "-threads", "0",  # 解码/解复用按 CPU 核数自动多线程
+    ]
+    if input_format:
+        cmd += ["-f", input_format]
+    cmd += ["-i", input_arg, *_STREAM_ARGS]
+    cmd += _COPY_ARGS if copy_audio else _ENCODE_ARGS
+    cmd += _MUXER_ARGS
+    cmd.append(str(out_path))
+    return cmd
+
+
+# ffmpeg 从管道解复用失败的特征（落盘后按文件重试可能成功）；其他失败（如无音频流）重试无意义。
+# 解复用失败时 ffmpeg 可能仍以 0 退出并写出空音频（如 moov 位于末尾的 mp4），因此不论退出码都要检查
+_PIPE_DEMUX_ERRORS = (
+    "partial file",
+    "Error during demuxing",
+    "moov atom not found",
+    "Error opening input",
+)
+
+
+def _is_pipe_demux_failure(stderr_tail: str) -> bool:
+    return any(marker in stderr_tail for marker in _PIPE_DEMUX_ERRORS)
+
+
+async def _convert_and_reply(msg, context: ContextTypes.DEFAULT_TYPE, video, filename: Optional[str]) -> Optional[str]:
+    """
+    下载/转换/回传音频；成功以音频发送时返回 Telegram 侧的 audio file_id，否则返回 None。
+    """
     status_msg = None
+    audio_file_id = None
 
     try:
+        # 超出大小上限：直接拒绝，不调用 get_file、不下载
+        if MAX_VIDEO_BYTES and (getattr(video, "file_size", None) or 0) > MAX_VIDEO_BYTES:
+            logger.info("Rejecting video of %s bytes (MAX_VIDEO_BYTES=%s)", video.file_size, MAX_VIDEO_BYTES)
+            await msg.reply_text(_too_large_text())
+            return None
+
         logger.info("Calling get_file for file_id=%s", video.file_id)
         file = await context.bot.get_file(video.file_id)
         fpath = str(getattr(file, "file_path", "") or "")
         fsize = getattr(file, "file_size", None)
         logger.info("get_file ok: file_size=%s, file_path=%s", fsize, fpath)
+        # 消息未携带大小时，以 get_file 返回的大小再检查一次
+        if MAX_VIDEO_BYTES and (fsize or 0) > MAX_VIDEO_BYTES:
+            logger.info("Rejecting video of %s bytes (MAX_VIDEO_BYTES=%s)", fsize, MAX_VIDEO_BYTES)
+            await msg.reply_text(_too_large_text())
+            return None
 
         local_source = _pick_local_source(fpath)
 
-        with tempfile.TemporaryDirectory(prefix="tg_v2a_") as td:
-            td_path = Path(td)
+        # 临时目录的清理（递归删除）放到线程中执行，避免阻塞事件循环
+        # 本地直读时源视频移入临时目录（rename 需与缓存同文件系统），不使用内存盘；仅下载时按需选择内存盘
+        tmp_root = TMPDIR_OVERRIDE if local_source else _pick_tmp_root(fsize)
+        td = tempfile.TemporaryDirectory(prefix="tg_v2a_", dir=tmp_root)
+        try:
+            td_path = Path(td.name)
             temp_dl = td_path / "input_video"
             out_name = _suggest_filename(filename, "audio", AUDIO_EXT)
             out_path = td_path / out_name
 
+            converted = False
+            input_path: Optional[Path] = None  # 需按文件转换的输入；管道转换已确定失败时保持 None
+
             # 下载阶段
             if local_source:
                 # 本地直读：直接进入转换阶段，仅发“转换中…”
                 status_msg = await msg.reply_text("转换中…")
-                input_path = Path(local_source)
+                adopted = await asyncio.to_thread(_adopt_local_source, local_source, temp_dl)
+                if adopted:
+                    input_path = adopted
+                    local_source = None  # 已移入临时目录，随其清理
+                else:
+                    input_path = Path(local_source)
                 logger.info("Using local source: %s", input_path)
+            elif fsize and fsize < SMALL_VIDEO_BYTES:
+                # 小文件（常见于圆形视频/短片）：下载到内存后经 stdin 转换，不落盘
+                status_msg = await msg.reply_text("下载中…")
+                try:
+                    data = await file.download_as_bytearray()
+                except Exception as dl_err:
+                    logger.error("In-memory download failed: %s", dl_err)
+                    try:
+                        await status_msg.edit_text("下载失败，请稍后重试。")
+                    except Exception:
+                        pass
+                    return None
+                try:
+                    await status_msg.edit_text("转换中…")
+                except Exception:
+                    pass
+                async with _ffmpeg_slot(status_msg, "转换中…"):
+                    rc, stderr_tail = await _bytes_to_ffmpeg(
+                        data, _build_ffmpeg_cmd("pipe:0", out_path, input_format=_pipe_demuxer_for(fpath))
+                    )
+                if _is_pipe_demux_failure(stderr_tail):
+                    # 无法从管道解复用（退出码可能仍为 0）：数据已在内存，直接写入临时文件后按文件转换，无需重新下载
+                    logger.warning("ffmpeg via stdin failed (rc=%s), retrying from file: %s", rc, stderr_tail)
+                    await asyncio.to_thread(_safe_unlink, out_path)
+                    await asyncio.to_thread(temp_dl.write_bytes, data)
+                    input_path = temp_dl
+                elif rc == 0:
+                    converted = True
+                del data
             else:
                 # 优先直链下载（可显示进度）；否则回退 PTB 下载（无法显示进度）
                 direct_url = _build_direct_file_url(fpath)
                 if direct_url:
                     status_msg = await msg.reply_text("下载中…")
                     try:
-                        await _download_with_progress(direct_url, temp_dl, status_msg)
-                        input_path = temp_dl
+                        if _FFMPEG_SEM.locked():
+                            # 转换名额已满：先落盘下载（不占名额，慢下载不会阻塞他人的转换），下载完再排队按文件转换
+                            await _download_with_progress(direct_url, temp_dl, status_msg, fsize)
+                            input_path = temp_dl
+                        else:
+                            # 边下载边转换：响应体直接写入 ffmpeg stdin
+                            async with _ffmpeg_slot(status_msg, "下载中…"):
+                                rc, stderr_tail = await _stream_to_ffmpeg(
+                                    direct_url,
+                                    _build_ffmpeg_cmd("pipe:0", out_path, input_format=_pipe_demuxer_for(fpath)),
+                                    status_msg,
+                                )
+                            if _is_pipe_demux_failure(stderr_tail):
+                                # 部分封装（如 moov 位于末尾的 mp4）无法从管道解复用（退出码可能仍为 0）：回退为落盘后转换
+                                logger.warning("ffmpeg via stdin failed (rc=%s), retrying from file: %s", rc, stderr_tail)
+                                await asyncio.to_thread(_safe_unlink, out_path)
+                                await _download_with_progress(direct_url, temp_dl, status_msg, fsize)
+                                input_path = temp_dl
+                            elif rc == 0:
+                                converted = True
+                    except _VideoTooLarge as e:
+                        logger.info("Aborting download: %s", e)
+                        try:
+                            await status_msg.edit_text(_too_large_text())
+                        except Exception:
+                            pass
+                        return None
                     except Exception as dl_err:
                         logger.error("Direct download failed: %s", dl_err)
                         try:
                             await status_msg.edit_text("下载失败，请稍后重试。")
                         except Exception:
                             pass
-                        return
+                        return None
                 else:
                     # 回退：无直链，只能下载完后再进入转换
                     status_msg = await msg.reply_text("下载中…")
@@ -365,51 +958,46 @@ async def handle_video_like(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             await status_msg.edit_text("下载失败，请稍后重试。")
                         except Exception:
                             pass
-                        return
-
-            # 转换阶段（写入有助于时长识别的容器/标签选项）
-            codec_map = {
-                "mp3": "libmp3lame",
-                "m4a": "aac",
-                "aac": "aac",
-                "opus": "libopus",
-                "ogg": "libopus",
-                "oga": "libopus",
-                "flac": "flac",
-                "wav": "pcm_s16le",
-            }
-            ext = AUDIO_EXT.lower()
-            acodec = codec_map.get(ext, "libmp3lame")
-            cmd = [
-                FFMPEG_BIN, "-y",
-                "-i", str(input_path),
-                "-vn",
-                "-acodec", acodec,
-            ]
-            if ext in {"mp3", "m4a", "aac", "opus", "ogg"} and AUDIO_BITRATE:
-                cmd += ["-b:a", AUDIO_BITRATE]
-            if ext in {"opus", "ogg"}:
-                cmd += ["-vbr", "on"]
-
-            # 关键：为不同封装补上便于 Telegram 识别时长的元数据/封装选项
-            if ext == "mp3":
-                # 写入 Xing/LAME 头以携带精确时长（尤其是 VBR）
-                cmd += ["-write_xing", "1", "-id3v2_version", "3"]
-            elif ext == "m4a":
-                # 将 moov 元数据前移，部分客户端依赖此以正确读取
-                cmd += ["-movflags", "+faststart"]
-            elif ext == "aac":
-                # ADTS 裸流本身对部分客户端不友好，时长可能不稳定
-                # 建议使用 m4a；这里保留 aac 以兼容你的选择
-                pass
-
-            cmd.append(str(out_path))
-
-            logger.info("Running ffmpeg: %s", shlex.join(cmd))
-            proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            if proc.returncode != 0 or not out_path.exists():
-                tail = (proc.stderr or "")[-2000:]
-                logger.error("ffmpeg failed: %s", tail)
+                        return None
+
+            # 转换阶段（已在下载时经 stdin 转换完成或已确定失败的跳过）
+            if not converted and input_path is not None:
+                async with _ffmpeg_slot(status_msg, "转换中…"):
+                    heartbeat = asyncio.create_task(
+                        _chat_action_heartbeat(context.bot, msg.chat_id, ChatAction.RECORD_VOICE)
+                    )
+                    try:
+                        # 源音频编码与目标一致时直接复制音频流
+                        src_codec, src_duration = await _probe_input(input_path)
+                        copy_audio = _can_copy_audio(src_codec)
+                        if copy_audio:
+                            logger.info("Source audio codec %s matches %s, using stream copy.", src_codec, AUDIO_EXT)
+
+                        last_progress_edit = time.monotonic()
+
+                        async def _on_progress(out_sec: float, out_bytes: int):
+                            nonlocal last_progress_edit
+                            now = time.monotonic()
+                            # 节流：远低于 Telegram 的编辑频率限制
+                            if not status_msg or now - last_progress_edit < FFMPEG_PROGRESS_INTERVAL:
+                                return
+                            last_progress_edit = now
+                            if src_duration:
+                                pct = min(int(out_sec * 100 / src_duration), 100)
+                                await status_msg.edit_text(f"转换中… {pct}% ({_human_size(out_bytes)})")
+                            else:
+                                await status_msg.edit_text(f"转换中… {_human_size(out_bytes)}")
+
+                        rc, stderr_tail = await _run_ffmpeg(
+                            _build_ffmpeg_cmd(str(input_path), out_path, copy_audio, progress=True),
+                            on_progress=_on_progress,
+                        )
+                    finally:
+                        heartbeat.cancel()
+                await asyncio.to_thread(_drop_page_cache, input_path)
+                converted = rc == 0  # ffmpeg 退出码即结果，无需再 stat 输出文件
+            if not converted:
+                logger.error("ffmpeg failed: %s", stderr_tail)
                 try:
                     if status_msg:
                         await status_msg.edit_text("转换失败，请稍后重试。")
@@ -417,26 +1005,27 @@ async def handle_video_like(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         await msg.reply_text("转换失败，请稍后重试。")
                 except Exception:
                     pass
-                _safe_remove_local_source(local_source)
-                return
+                await asyncio.to_thread(_safe_remove_local_source, local_source)
+                return None
 
             # 用 ffprobe 读取时长并传给 sendAudio，确保 Telegram 能显示总时长/进度
-            duration_sec = _probe_duration_seconds(out_path)
+            duration_sec = await _probe_duration_seconds(out_path)
 
             # 发送音频（无 caption），发送成功后删除“状态消息”
             send_ok = False
             try:
-                with open(out_path, "rb") as f:
-                    kwargs = {"filename": out_name}
-                    if duration_sec and duration_sec > 0:
-                        kwargs["duration"] = int(duration_sec)
-                    await msg.reply_audio(audio=f, **kwargs)
+                # 直接传 Path，由 PTB 自行读取/上传，无需在此打开文件
+                kwargs = {"filename": out_name}
+                if duration_sec and duration_sec > 0:
+                    kwargs["duration"] = int(duration_sec)
+                sent = await msg.reply_audio(audio=out_path, **kwargs)
                 send_ok = True
+                if sent and sent.audio:
+                    audio_file_id = sent.audio.file_id
             except Exception as send_err:
                 logger.warning("send_audio failed, fallback to send_document: %s", send_err)
                 try:
-                    with open(out_path, "rb") as f:
-                        await msg.reply_document(document=f, filename=out_name)
+                    await msg.reply_document(document=out_path, filename=out_name)
                     send_ok = True
                 except Exception as send_err2:
                     logger.error("send_document also failed: %s", send_err2)
@@ -444,8 +1033,8 @@ async def handle_video_like(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             # 清理与收尾
             if CLEANUP_OUTPUT:
-                _safe_unlink(out_path)
-            _safe_remove_local_source(local_source)
+                await asyncio.to_thread(_safe_unlink, out_path)
+            await asyncio.to_thread(_safe_remove_local_source, local_source)
 
             if send_ok and status_msg:
                 try:
@@ -460,6 +1049,8 @@ async def handle_video_like(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         await msg.reply_text("发送失败，请稍后重试。")
                 except Exception:
                     pass
+        finally:
+            await asyncio.to_thread(td.cleanup)
 
     except Exception as e:
         logger.exception("Processing error: %s", e)
@@ -471,6 +1062,159 @@ async def handle_video_like(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             pass
 
+    return audio_file_id
+
+
+def _audio_cache_get(key: tuple) -> Optional[str]:
+    entry = _AUDIO_CACHE.get(key)
+    if entry is None:
+        return None
+    audio_file_id, expires_at = entry
+    if expires_at < time.monotonic():
+        _AUDIO_CACHE.pop(key, None)
+        return None
+    _AUDIO_CACHE.move_to_end(key)
+    return audio_file_id
+
+
+def _audio_cache_put(key: tuple, audio_file_id: str):
+    if AUDIO_CACHE_SIZE <= 0:
+        return
+    _AUDIO_CACHE[key] = (audio_file_id, time.monotonic() + AUDIO_CACHE_TTL)
+    _AUDIO_CACHE.move_to_end(key)
+    while len(_AUDIO_CACHE) > AUDIO_CACHE_SIZE:
+        _AUDIO_CACHE.popitem(last=False)
+
+
+async def _reply_cached_audio(msg, audio_file_id: str) -> bool:
+    try:
+        await msg.reply_audio(audio=audio_file_id)
+        return True
+    except Exception as e:
+        logger.warning("Resend by cached audio file_id failed: %s", e)
+        return False
+
+
+async def handle_video_like(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # 只维护一个“进度/状态”消息：下载中…（带进度/速度）→ 转换中… → 成功后删除；失败则将其改为错误信息
+    if not _FFMPEG_OK:
+        try:
+            await update.effective_message.reply_text("转换失败：服务器未安装 ffmpeg。")
+        except Exception:
+            pass
+        return
+
+    msg = update.effective_message
+    video = None
+    filename = None
+
+    if msg.video:
+        video = msg.video
+        filename = getattr(video, "file_name", None)
+    elif msg.video_note:
+        video = msg.video_note
+        filename = None
+    elif msg.document and msg.document.mime_type and msg.document.mime_type.startswith("video/"):
+        video = msg.document
+        filename = msg.document.file_name
+
+    if not video:
+        return  # 不多发消息
+
+    # 同一视频：已有缓存则按 Telegram file_id 直接转发（零上传）；并发的重复请求等待首个转换结果
+    # file_unique_id 对同一文件恒定（file_id 随转发者/机器人而不同），用它去重命中率更高
+    key = (getattr(video, "file_unique_id", None) or video.file_id, AUDIO_EXT, AUDIO_BITRATE)
+    while True:
+        audio_file_id = _audio_cache_get(key)
+        if audio_file_id is None:
+            pending = _INFLIGHT.get(key)
+            if pending is None:
+                break  # 无缓存且无人在转换：由本请求负责转换
+            # 首个转换失败时结果为 None：回到循环，已有其他请求接手则等待其结果，否则由本请求重试
+            audio_file_id = await asyncio.shield(pending)
+            if audio_file_id is None:
+                continue
+        if await _reply_cached_audio(msg, audio_file_id):
+            return
+        _AUDIO_CACHE.pop(key, None)
+
+    fut = asyncio.get_running_loop().create_future()
+    _INFLIGHT[key] = fut
+    audio_file_id = None
+    try:
+        audio_file_id = await _convert_and_reply(msg, context, video, filename)
+        if audio_file_id:
+            _audio_cache_put(key, audio_file_id)
+    finally:
+        _INFLIGHT.pop(key, None)
+        fut.set_result(audio_file_id)  # None：本次转换失败，等待者中的一个接手重试
+
+
+async def handle_audio_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    已是音频的文档（audio/*）：无需 ffmpeg，直接以音频形式回传。
+    优先按 file_id 引用（服务端完成，零传输）；Telegram 拒绝跨类型引用时下载后原样上传。
+    """
+    msg = update.effective_message
+    doc = msg.document
+    if not doc:
+        return
+
+    try:
+        await msg.reply_audio(audio=doc.file_id)
+        return
+    except Exception as e:
+        logger.info("Resend audio document by file_id failed, re-uploading: %s", e)
+
+    try:
+        # 需下载后重传：与视频相同的大小上限（先看消息里的大小，缺失时看 get_file 返回的大小）
+        if MAX_VIDEO_BYTES and (doc.file_size or 0) > MAX_VIDEO_BYTES:
+            logger.info("Rejecting audio document of %s bytes (MAX_VIDEO_BYTES=%s)", doc.file_size, MAX_VIDEO_BYTES)
+            await msg.reply_text(_too_large_text())
+            return
+        file = await context.bot.get_file(doc.file_id)
+        if MAX_VIDEO_BYTES and (file.file_size or 0) > MAX_VIDEO_BYTES:
+            logger.info("Rejecting audio document of %s bytes (MAX_VIDEO_BYTES=%s)", file.file_size, MAX_VIDEO_BYTES)
+            await msg.reply_text(_too_large_text())
+            return
+        ext = Path(doc.file_name or "").suffix or mimetypes.guess_extension(doc.mime_type or "") or ".mp3"
+        td = tempfile.TemporaryDirectory(prefix="tg_v2a_", dir=TMPDIR_OVERRIDE)
+        try:
+            path = Path(td.name) / _suggest_filename(doc.file_name, "audio", ext)
+            await file.download_to_drive(custom_path=path)
+            await msg.reply_audio(audio=path, filename=path.name)
+        finally:
+            await asyncio.to_thread(td.cleanup)
+    except Exception as e:
+        logger.exception("Audio document passthrough failed: %s", e)
+        try:
+            await msg.reply_text("发送失败，请稍后重试。")
+        except Exception:
+            pass
+
+
+# 视频类消息：视频 / 圆形视频 / video/* 文档（Document.VIDEO 按前缀匹配；MimeType 需完全相等）
+_VIDEO_FILTER = filters.VIDEO | filters.VIDEO_NOTE | filters.Document.VIDEO
+
+
+class _AllowedFilter(filters.UpdateFilter):
+    """
+    白名单过滤器：effective_user 或 effective_chat 命中任一白名单即放行。
+    每个更新最多两次 frozenset 成员判断，不经过组合过滤器的逐层求值。
+    """
+
+    def __init__(self, user_ids: frozenset[int], chat_ids: frozenset[int]):
+        super().__init__(name="AllowedFilter")
+        self._user_ids = user_ids
+        self._chat_ids = chat_ids
+
+    def filter(self, update: Update) -> bool:
+        user = update.effective_user
+        if user is not None and user.id in self._user_ids:
+            return True
+        chat = update.effective_chat
+        return chat is not None and chat.id in self._chat_ids
+
 
 # 全局错误处理
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
@@ -487,55 +1231,70 @@ def _build_request_safe():
         logger.warning("HTTPXRequest not available; using default PTB request.")
         return None
 
-    # 分级降级，适配不同 ptb 版本
-    try:
-        limits = httpx.Limits(max_keepalive_connections=MAX_KEEPALIVE, max_connections=MAX_CONNECTIONS)
-        req = HTTPXRequest(
-            connect_timeout=CONNECT_TIMEOUT,
-            read_timeout=READ_TIMEOUT,
-            write_timeout=WRITE_TIMEOUT,
-            pool_limits=limits,
-        )
-        logger.info("Using HTTPXRequest with pool_limits.")
-        return req
-    except TypeError as te:
-        logger.info("HTTPXRequest(pool_limits=...) unsupported in this PTB version: %s", te)
-    except Exception as e:
-        logger.info("HTTPXRequest with pool_limits failed: %s", e)
-
-    try:
-        req = HTTPXRequest(
-            connect_timeout=CONNECT_TIMEOUT,
-            read_timeout=READ_TIMEOUT,
-            write_timeout=WRITE_TIMEOUT,
-            pool_timeout=POOL_TIMEOUT,
-        )
-        logger.info("Using HTTPXRequest with pool_timeout.")
-        return req
-    except TypeError as te:
-        logger.info("HTTPXRequest(pool_timeout=...) unsupported in this PTB version: %s", te)
-    except Exception as e:
-        logger.info("HTTPXRequest with pool_timeout failed: %s", e)
+    # 按当前 ptb 版本支持的参数组装（_HTTPX_REQUEST_PARAMS 于导入时探测）
+    kwargs = {
+        "connect_timeout": CONNECT_TIMEOUT,
+        "read_timeout": READ_TIMEOUT,
+        "write_timeout": WRITE_TIMEOUT,
+    }
+    if "pool_limits" in _HTTPX_REQUEST_PARAMS:
+        kwargs["pool_limits"] = httpx.Limits(max_keepalive_connections=MAX_KEEPALIVE, max_connections=MAX_CONNECTIONS)
+    elif "pool_timeout" in _HTTPX_REQUEST_PARAMS:
+        kwargs["pool_timeout"] = POOL_TIMEOUT
+    if "connection_pool_size" in _HTTPX_REQUEST_PARAMS:
+        # 自定义 HTTPXRequest 的默认连接池大小为 1，会让并发的 API 调用排队
+        kwargs["connection_pool_size"] = MAX_CONNECTIONS
+    # HTTP/2：转换完成后的一串 API 调用复用同一连接多路传输，并用 HPACK 压缩请求头。
+    # 仅限 https（经 ALPN 协商）；http:// 上会以 h2c 直连，而自建 telegram-bot-api 只支持 HTTP/1.1
+    api_is_https = (TG_BASE_URL or "https://api.telegram.org").lower().startswith("https://")
+    if _HAS_H2 and api_is_https and "http_version" in _HTTPX_REQUEST_PARAMS:
+        kwargs["http_version"] = "2"
 
     try:
-        req = HTTPXRequest(
-            connect_timeout=CONNECT_TIMEOUT,
-            read_timeout=READ_TIMEOUT,
-            write_timeout=WRITE_TIMEOUT,
-        )
-        logger.info("Using HTTPXRequest with basic timeouts only.")
+        req = HTTPXRequest(**kwargs)
+        logger.info("Using HTTPXRequest with %s.", ", ".join(kwargs))
         return req
     except Exception as e:
-        logger.warning("HTTPXRequest basic construction failed: %s. Will fallback to PTB default request.", e)
+        logger.warning("HTTPXRequest construction failed: %s. Will fallback to PTB default request.", e)
         return None
 
 
+async def _close_httpx_client(application: Application):
+    global _HTTPX_CLIENT
+    if _HTTPX_CLIENT is not None:
+        await _HTTPX_CLIENT.aclose()
+        _HTTPX_CLIENT = None
+
+
 def _build_application() -> Application:
     if not BOT_TOKEN:
         raise SystemExit("请设置环境变量 BOT_TOKEN=你的TelegramBotToken")
 
+    global _FFMPEG_OK
+    _FFMPEG_OK = _has_ffmpeg()
+    if not _FFMPEG_OK:
+        logger.warning("ffmpeg not found (FFMPEG_BIN=%s); conversions will be refused.", FFMPEG_BIN)
+
+    if TMPDIR_OVERRIDE:
+        os.makedirs(TMPDIR_OVERRIDE, exist_ok=True)
+
+    # 本地模式只传文件路径：临时目录必须位于 bot-api 也能以相同路径访问的共享卷内，
+    # 未显式指定 TG_V2A_TMPDIR 时输出可能落在 /dev/shm 或本容器 /tmp，每次发送都会失败
+    global TG_LOCAL_MODE
+    if TG_LOCAL_MODE and not TMPDIR_OVERRIDE:
+        logger.warning("TG_LOCAL_MODE requires TG_V2A_TMPDIR on a volume shared with the Bot API server; disabled.")
+        TG_LOCAL_MODE = False
+
     request = _build_request_safe()
 
+    global _HTTPX_CLIENT
+    _HTTPX_CLIENT = httpx.AsyncClient(
+        timeout=httpx.Timeout(connect=CONNECT_TIMEOUT, read=READ_TIMEOUT, write=WRITE_TIMEOUT, pool=POOL_TIMEOUT),
+        limits=httpx.Limits(max_keepalive_connections=MAX_KEEPALIVE, max_connections=MAX_CONNECTIONS),
+        follow_redirects=True,
+        http2=_HAS_H2,
+    )
+
     def _normalize_urls():
         base_url = TG_BASE_URL
         file_base = TG_FILE_BASE_URL or TG_BASE_URL
@@ -557,36 +1316,33 @@ def _build_application() -> Application:
 
     if base_url:
         logger.info("Using self-hosted Bot API server: base_url=%s | base_file_url=%s", base_url, file_base)
+        if TG_LOCAL_MODE:
+            logger.info("Local mode enabled: uploads are passed to the Bot API server by file path.")
         if request is not None:
-            bot = Bot(token=BOT_TOKEN, base_url=base_url, base_file_url=file_base, request=request)
+            bot = Bot(token=BOT_TOKEN, base_url=base_url, base_file_url=file_base, request=request,
+                      local_mode=TG_LOCAL_MODE)
             app_builder = Application.builder().bot(bot)
         else:
-            bot = Bot(token=BOT_TOKEN, base_url=base_url, base_file_url=file_base)
+            bot = Bot(token=BOT_TOKEN, base_url=base_url, base_file_url=file_base, local_mode=TG_LOCAL_MODE)
             app_builder = Application.builder().bot(bot)
     else:
+        if TG_LOCAL_MODE:
+            logger.warning("TG_LOCAL_MODE requires a self-hosted Bot API server (TG_BASE_URL); ignored.")
         if request is not None:
             app_builder = Application.builder().token(BOT_TOKEN).request(request)
         else:
             app_builder = Application.builder().token(BOT_TOKEN)
 
-    app = app_builder.build()
-
-    # 授权过滤器：组合用户与聊天白名单
-    user_filter = filters.User(user_id=list(ALLOWED_USER_IDS)) if ALLOWED_USER_IDS else None
-    chat_filter = filters.Chat(chat_id=list(ALLOWED_CHAT_IDS)) if ALLOWED_CHAT_IDS else None
+    # 并发处理更新：转换期间其他消息不再排队等待；ffmpeg 并发由 _FFMPEG_SEM 限制
+    app = app_builder.concurrent_updates(True).post_shutdown(_close_httpx_client).build()
 
-    if user_filter and chat_filter:
-        allowed_filter = user_filter | chat_filter
+    # 授权过滤器：用户与聊天白名单合并为一个过滤器
+    if ALLOWED_USER_IDS or ALLOWED_CHAT_IDS:
+        allowed_filter = _AllowedFilter(ALLOWED_USER_IDS, ALLOWED_CHAT_IDS)
         logger.info(
             "Authorization enabled. Allowed users: %s | Allowed chats: %s",
             sorted(ALLOWED_USER_IDS), sorted(ALLOWED_CHAT_IDS)
         )
-    elif user_filter:
-        allowed_filter = user_filter
-        logger.info("Authorization enabled. Allowed users: %s", sorted(ALLOWED_USER_IDS))
-    elif chat_filter:
-        allowed_filter = chat_filter
-        logger.info("Authorization enabled. Allowed chats: %s", sorted(ALLOWED_CHAT_IDS))
     else:
         allowed_filter = filters.ALL
         logger.info("Authorization disabled (ALLOWED_USER_IDS & ALLOWED_CHAT_IDS empty). Bot is open to all chats/users.")
@@ -594,8 +1350,8 @@ def _build_application() -> Application:
     # Handlers（均附带授权过滤器）
     app.add_handler(CommandHandler("start", lambda u, c: u.message.reply_text("发送视频即可，我会返回音频。"), filters=allowed_filter))
     app.add_handler(CommandHandler("help", lambda u, c: u.message.reply_text("发送视频，我会抽取音频并返回。"), filters=allowed_filter))
-    app.add_handler(MessageHandler((filters.VIDEO | filters.VIDEO_NOTE) & allowed_filter, handle_video_like))
-    app.add_handler(MessageHandler(filters.Document.MimeType("video/") & allowed_filter, handle_video_like))
+    app.add_handler(MessageHandler(_VIDEO_FILTER & allowed_filter, handle_video_like))
+    app.add_handler(MessageHandler(filters.Document.AUDIO & allowed_filter, handle_audio_document))
     app.add_error_handler(error_handler)
 
     return app